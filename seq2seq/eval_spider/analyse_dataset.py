@@ -1,17 +1,19 @@
 from evaluation import count_component1, count_component2, count_others
 
-import json
 import os
 import sys
 
-AGG_OPS = ('none', 'max', 'min', 'count', 'sum', 'avg')
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
+AGG_OPS = ('none', 'max', 'min', 'count', 'sum', 'avg')
+AGG_OPS_SP = tuple(op + ' ' for op in AGG_OPS)
+ORDER_BY_STRS = {order: f"ORDER BY {order} " for order in ('asc', 'desc')}
 
-def eval_hardness(sql):
-    count_comp1_ = count_component1(sql)
-    count_comp2_ = count_component2(sql)
-    count_others_ = count_others(sql)
 
+def _classify_hardness(count_comp1_, count_comp2_, count_others_):
     if count_comp1_ <= 1 and count_others_ == 0 and count_comp2_ == 0:
         return "easy"
     elif (count_others_ <= 2 and count_comp1_ <= 1 and count_comp2_ == 0) or \
@@ -25,103 +27,144 @@ def eval_hardness(sql):
         return "extra"
 
 
+# The thresholds above never look past these values, so larger counts are clipped
+# and the hardness is read from a table built once at import time
+MAX_COMP1, MAX_COMP2, MAX_OTHERS = 5, 3, 7
+HARDNESS_TABLE = {
+    (c1, c2, others): _classify_hardness(c1, c2, others)
+    for c1 in range(MAX_COMP1 + 1)
+    for c2 in range(MAX_COMP2 + 1)
+    for others in range(MAX_OTHERS + 1)
+}
+
+
+def eval_hardness(sql):
+    return HARDNESS_TABLE[(
+        min(count_component1(sql), MAX_COMP1),
+        min(count_component2(sql), MAX_COMP2),
+        min(count_others(sql), MAX_OTHERS),
+    )]
+
+
 def form_clause_str(sql_dict, delimiter='|'):
     """
     Given a dictionary of SQL clauses, form a string encoding them
     """
+    # look every clause up once and keep the hot names local
+    get_clause = sql_dict.get
+    select = get_clause('select')
+    from_clause = get_clause('from')
+    where = get_clause('where')
+    group_by = get_clause('groupBy')
+    having = get_clause('having')
+    order_by = get_clause('orderBy')
+    limit = get_clause('limit')
+    union = get_clause('union')
+    intersect = get_clause('intersect')
+    except_ = get_clause('except')
+    agg_ops = AGG_OPS_SP
+
+    parts = ["SELECT "]
+    append = parts.append
+
     # select clause
-    select = sql_dict.get('select')
-    clause_str = "" + "SELECT "
-    no_clauses = 0 + 1
     if select[0]:
-        clause_str += "DISTINCT "
+        append("DISTINCT ")
     for unit in select[1]:
         if unit[0] != 0:
-            clause_str += f"{AGG_OPS[unit[0]]} "
-    clause_str += delimiter
+            append(agg_ops[unit[0]])
+    append(delimiter)
 
     # from clause
-    from_clause = sql_dict.get('from')
-    clause_str += "FROM "
-    no_clauses += 1
-    clause_str += delimiter
+    append("FROM ")
+    append(delimiter)
 
     # number of tables in from clause
     no_tables = len(from_clause.get('table_units', []))
-    clause_str += str(no_tables)
-    clause_str += delimiter
+    append(str(no_tables))
+    append(delimiter)
 
-    if where := sql_dict.get('where'):
-        clause_str += "WHERE "
-        no_clauses += 1
+    if where:
+        append("WHERE ")
         if 'and' in where:
-            clause_str += "AND "
+            append("AND ")
         if 'or' in where:
-            clause_str += "OR "
+            append("OR ")
         for unit in where:
-            if type(unit) != str and (
-                type(unit[3]) == dict or type(unit[4]) == dict
+            if not isinstance(unit, str) and (
+                unit[3].__class__ is dict or unit[4].__class__ is dict
             ):
-                clause_str += "SUBQUERY "
+                append("SUBQUERY ")
                 break
-    clause_str += delimiter
+    append(delimiter)
 
-    if group_by := sql_dict.get('groupBy'):
-        clause_str += "GROUP BY "
-        no_clauses += 1
-    clause_str += delimiter
+    if group_by:
+        append("GROUP BY ")
+    append(delimiter)
 
-    if having := sql_dict.get('having'):
-        clause_str += "HAVING "
-        no_clauses += 1
+    if having:
+        append("HAVING ")
         if 'and' in having:
-            clause_str += "AND "
+            append("AND ")
         if 'or' in having:
-            clause_str += "OR "
+            append("OR ")
+        has_subquery = False
         for unit in having:
-            if type(unit) != str:
+            if not isinstance(unit, str):
                 if unit[2][1][0] != 0:
-                    clause_str += f"{AGG_OPS[unit[2][1][0]]} "
+                    append(agg_ops[unit[2][1][0]])
                 if unit[2][2] and unit[2][2][0] != 0:
-                    clause_str += f"{AGG_OPS[unit[2][2][0]]} "
-        for unit in having:
-            if type(unit) != str and (
-                type(unit[3]) == dict or type(unit[4]) == dict
-            ):
-                clause_str += "SUBQUERY "
-                break
-    clause_str += delimiter
-
-    if order_by := sql_dict.get('orderBy'):
-        clause_str += f"ORDER BY {order_by[0]} "
-        no_clauses += 1
-    clause_str += delimiter
-
-    if limit := sql_dict.get('limit'):
-        clause_str += f"LIMIT {str(limit)} "
-        no_clauses += 1
-    clause_str += delimiter
+                    append(agg_ops[unit[2][2][0]])
+                if unit[3].__class__ is dict or unit[4].__class__ is dict:
+                    has_subquery = True
+        # SUBQUERY is listed after all of the aggregates
+        if has_subquery:
+            append("SUBQUERY ")
+    append(delimiter)
+
+    if order_by:
+        append(ORDER_BY_STRS[order_by[0]])
+    append(delimiter)
+
+    if limit:
+        append(f"LIMIT {str(limit)} ")
+    append(delimiter)
+
+    if union:
+        append("UNION ")
+    append(delimiter)
+
+    if intersect:
+        append("INTERSECT ")
+    append(delimiter)
 
-    if union := sql_dict.get('union'):
-        clause_str += "UNION "
-        no_clauses += 1
-    clause_str += delimiter
+    # except clause
+    if except_:
+        append("EXCEPT ")
+    append(delimiter)
 
-    if intersect := sql_dict.get('intersect'):
-        clause_str += "INTERSECT "
-        no_clauses += 1
-    clause_str += delimiter
+    # number of clauses, SELECT and FROM are always present
+    no_clauses = 2 + sum(map(bool, (where, group_by, having, order_by, limit, union, intersect, except_)))
+    append(str(no_clauses))
 
-    # except clause
-    if sql_dict.get('except'):
-        clause_str += "EXCEPT "
-        no_clauses += 1
-    clause_str += delimiter
+    return ''.join(parts)
 
-    # number of clauses
-    clause_str += str(no_clauses)
 
-    return clause_str
+def format_instance(instance, delimiter='|'):
+    """
+    Forms the line of statistics written for a single dataset instance
+    """
+    query = instance['query']
+    question = instance['question']
+    sql = instance['sql']
+    return ''.join((
+        query, f" {delimiter} ",
+        question, f" {delimiter} ",
+        eval_hardness(sql), f" {delimiter} ",
+        form_clause_str(sql, delimiter), f" {delimiter}",
+        str(len(query)), f" {delimiter}",
+        str(len(question)), '\n',
+    ))
 
 
 def analyse_dataset(dataset_name):
@@ -129,35 +172,18 @@ def analyse_dataset(dataset_name):
     Prints statistics on the gold queries for a given dataset
     """
     delimiter = '|'
-    query_data = []
 
     dataset_file = f"../../dataset_files/ori_dataset/{dataset_name}/"
     dataset_file += "spider-DK.json" if dataset_name == "spider_dk" else "dev.json"
-    with open(dataset_file, 'r') as input_file:
-        instances = json.load(input_file)
-        for i in instances:
-            instance_str = ""
-
-            # Append statistics to a string
-            instance_str += i['query']
-            instance_str += f" {delimiter} "
-            instance_str += i['question']
-            instance_str += f" {delimiter} "
-            instance_str += eval_hardness(i['sql'])
-            instance_str += f" {delimiter} "
-            instance_str += form_clause_str(i['sql'], delimiter)
-            instance_str += f" {delimiter}"
-            instance_str += str(len(i['query']))
-            instance_str += f" {delimiter}"
-            instance_str += str(len(i['question']))
-
-            query_data.append(instance_str)
-
     out_filename = f"../../dataset_files/statistics/{dataset_name}.txt"
 
-    with open(out_filename, 'w') as output_file:
-        for q in query_data:
-            output_file.write(q + '\n')
+    with open(dataset_file, 'rb') as input_file:
+        instances = json_loads(input_file.read())
+
+    # Only open (and truncate) the output once the dataset has been parsed successfully
+    with open(out_filename, 'w', buffering=1 << 20) as output_file:
+        for i in instances:
+            output_file.write(format_instance(i, delimiter))
 
     print(f"Wrote result to {out_filename}")
     print('Result can be pasted into Google Sheets with Ctrl-V --> click Paste Options at bottom-right --> Split text to columns --> Change separator --> Custom --> Type "|" --> Enter')
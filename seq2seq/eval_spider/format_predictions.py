@@ -1,7 +1,16 @@
-import json
 import os
 import sys
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 
 def get_sql_predictions_filename(predictions_filename):
     """
@@ -11,22 +20,32 @@ def get_sql_predictions_filename(predictions_filename):
     return os.path.join(predictions_dir, 'predictions.sql')
 
 
+def iter_predictions(input_file):
+    """
+    Yields the prediction records of a .json file one at a time, streaming with ijson when it is installed
+    """
+    if ijson is not None:
+        return ijson.items(input_file, 'item')
+    return iter(json_loads(input_file.read()))
+
+
 def format_predictions(in_filename):
     """
     Formats predicted SQL queries from a .json file to a .sql file so they can be evaluated
     """
-    predicted_queries = []
-
-    with open(in_filename, 'r') as input_file:
-        all_predictions = json.loads(input_file.read())
-        predicted_queries.extend(
-            p['prediction'].split('| ')[-1] for p in all_predictions
-        )
     out_filename = get_sql_predictions_filename(in_filename)
+    tmp_filename = out_filename + '.tmp'
 
-    with open(out_filename, 'w') as output_file:
-        for q in predicted_queries:
-            output_file.write(q + '\n')
+    # Stream into a temporary file so a parse error midway leaves any previous output intact
+    try:
+        with open(in_filename, 'rb') as input_file, open(tmp_filename, 'w') as output_file:
+            for p in iter_predictions(input_file):
+                output_file.write(p['prediction'].rpartition('| ')[2] + '\n')
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    os.replace(tmp_filename, out_filename)
 
 if __name__ == "__main__":
     if len(sys.argv) != 2:
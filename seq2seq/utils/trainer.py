@@ -1,7 +1,6 @@
 import collections
 import torch
 from torch import nn
-from torch.cuda.amp import autocast
 from typing import Any, Dict, List, Optional, NamedTuple, Tuple, Union
 import transformers.trainer_seq2seq
 from transformers.file_utils import WEIGHTS_NAME
@@ -10,12 +9,32 @@ from transformers.trainer_utils import PredictionOutput, speed_metrics
 from datasets.arrow_dataset import Dataset
 from datasets.metric import Metric
 import numpy as np
+import logging
 import time
 import os
 
+try:
+    from safetensors.torch import save_file as safe_save_file
+    from transformers.utils import SAFE_WEIGHTS_NAME
+except ImportError:
+    safe_save_file = None
+
+logger = logging.getLogger(__name__)
+
 TRAINING_ARGS_NAME = "training_args.bin"
 
 
+def _untie_tensors(state_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    # safetensors refuses tensors that share memory, e.g. T5's tied embeddings, so copy all but the first
+    tensors = {}
+    seen_ptrs = set()
+    for name, tensor in state_dict.items():
+        tensor = tensor.contiguous()
+        tensors[name] = tensor.clone() if tensor.data_ptr() in seen_ptrs else tensor
+        seen_ptrs.add(tensor.data_ptr())
+    return tensors
+
+
 class EvalPrediction(NamedTuple):
     predictions: List[str]
     label_ids: np.ndarray
@@ -42,6 +61,49 @@ class Seq2SeqTrainer(transformers.trainer_seq2seq.Seq2SeqTrainer):
         self.target_with_db_id = target_with_db_id
         self.control.should_save = should_save
         self.push_to_hub = push_to_hub
+        self._unwrapped_model = None
+        self._unwrapped_model_source = None
+        self._gen_defaults = None
+        self._warned_eval_batch_size = False
+
+    def _get_unwrapped_model(self) -> nn.Module:
+        # Unwrapping only needs to be redone when self.model itself is replaced
+        if self._unwrapped_model_source is not self.model:
+            self._unwrapped_model = unwrap_model(self.model)
+            self._unwrapped_model_source = self.model
+            config = self._unwrapped_model.config
+            self._gen_defaults = {
+                "max_length": config.max_length,
+                "num_beams": config.num_beams,
+                "pad_token_id": config.pad_token_id,
+            }
+        return self._unwrapped_model
+
+    def _warn_if_eval_batch_size_untuned(self) -> None:
+        # Generation keeps no activations for backward, so eval batches usually fit well beyond the train size
+        if self._warned_eval_batch_size:
+            return
+        self._warned_eval_batch_size = True
+        if self.args.per_device_eval_batch_size == self.args.per_device_train_batch_size:
+            logger.warning(
+                f"per_device_eval_batch_size equals per_device_train_batch_size "
+                f"({self.args.per_device_eval_batch_size}); a larger eval batch size usually speeds up generation."
+            )
+
+    def _pad_tensors_to_max_len(self, tensor: torch.Tensor, max_length: int) -> torch.Tensor:
+        # Pads in a single allocation; the parent builds a ones tensor, scales it and then copies into it.
+        # The result must not be a reused buffer, because evaluation_loop keeps the first batch's tensor as is.
+        if self.tokenizer is not None and hasattr(self.tokenizer, "pad_token_id"):
+            # If PAD token is not defined at least EOS token has to be defined
+            pad_token_id = (
+                self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+            )
+        else:
+            if self.model.config.pad_token_id is not None:
+                pad_token_id = self.model.config.pad_token_id
+            else:
+                raise ValueError("Pad_token_id must be set in the configuration of the model, in order to pad tensors")
+        return nn.functional.pad(tensor, (0, max_length - tensor.shape[-1]), value=pad_token_id)
 
     def _compute_metrics(self, eval_prediction: EvalPrediction) -> dict:
         raise NotImplementedError()
@@ -64,6 +126,7 @@ class Seq2SeqTrainer(transformers.trainer_seq2seq.Seq2SeqTrainer):
         self._max_length = max_length
         self._max_time = max_time
         self._num_beams = num_beams
+        self._warn_if_eval_batch_size_untuned()
 
         # memory metrics - must set up as early as possible
         self._memory_tracker.start()
@@ -137,6 +200,7 @@ class Seq2SeqTrainer(transformers.trainer_seq2seq.Seq2SeqTrainer):
         self._max_length = max_length
         self._max_time = max_time
         self._num_beams = num_beams
+        self._warn_if_eval_batch_size_untuned()
 
         # memory metrics - must set up as early as possible
         self._memory_tracker.start()
@@ -185,6 +249,12 @@ class Seq2SeqTrainer(transformers.trainer_seq2seq.Seq2SeqTrainer):
 
         return output
 
+    def _prepare_input(self, data: Union[torch.Tensor, Any]) -> Union[torch.Tensor, Any]:
+        # Copy batches to the device asynchronously; the dataloader pins memory by default (dataloader_pin_memory)
+        if isinstance(data, torch.Tensor) and not self.deepspeed:
+            return data.to(self.args.device, non_blocking=True)
+        return super()._prepare_input(data)
+
     def prediction_step(
         self,
         model: nn.Module,
@@ -203,37 +273,38 @@ class Seq2SeqTrainer(transformers.trainer_seq2seq.Seq2SeqTrainer):
         inputs = self._prepare_inputs(inputs)
         
         # Extract the model from any wrapper classes, e.g. DistributedDataParallel
-        unwrapped_model = unwrap_model(self.model)
+        unwrapped_model = self._get_unwrapped_model()
+        gen_defaults = self._gen_defaults
 
         # XXX: adapt synced_gpus for fairscale as well
         gen_kwargs = {
-            "max_length": self._max_length if self._max_length is not None else unwrapped_model.config.max_length,
-            "num_beams": self._num_beams if self._num_beams is not None else unwrapped_model.config.num_beams,
+            "max_length": self._max_length if self._max_length is not None else gen_defaults["max_length"],
+            "num_beams": self._num_beams if self._num_beams is not None else gen_defaults["num_beams"],
             "synced_gpus": False,
+            "use_cache": True,
+            "pad_token_id": gen_defaults["pad_token_id"],
         }
 
-        generated_tokens = unwrapped_model.generate(
-            inputs["input_ids"],
-            attention_mask=inputs["attention_mask"],
-            **gen_kwargs,
-        )
+        # Generation dominates eval time, so it runs under the same fp16/bf16 autocast as the loss forward
+        with self.autocast_smart_context_manager():
+            generated_tokens = unwrapped_model.generate(
+                inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                **gen_kwargs,
+            )
         # in case the batch is shorter than max length, the output should be padded
         if generated_tokens.shape[-1] < gen_kwargs["max_length"]:
             generated_tokens = self._pad_tensors_to_max_len(generated_tokens, gen_kwargs["max_length"])
 
-        with torch.no_grad():
-            if self.use_amp:
-                with autocast():
-                    outputs = model(**inputs)
-            else:
+        # The teacher-forced forward pass is only needed for the loss, so skip it without labels
+        loss = None
+        if has_labels:
+            with torch.inference_mode(), self.autocast_smart_context_manager():
                 outputs = model(**inputs)
-            if has_labels:
                 if self.label_smoother is not None:
                     loss = self.label_smoother(outputs, inputs["labels"]).mean().detach()
                 else:
                     loss = (outputs["loss"] if isinstance(outputs, dict) else outputs[0]).mean().detach()
-            else:
-                loss = None
 
         if self.args.prediction_loss_only:
             return (loss, None, None)
@@ -253,21 +324,27 @@ class Seq2SeqTrainer(transformers.trainer_seq2seq.Seq2SeqTrainer):
         # They can then be reloaded using `from_pretrained()`
         print(f'Model type: {type(self.model)}')
         print(f'Unwrapped model type: {type(unwrap_model(self.model))}')
+        # save_safetensors only exists in Trainer releases that can also load safetensors checkpoints back
+        save_safetensors = safe_save_file is not None and getattr(self.args, "save_safetensors", False)
+        save_kwargs = {"safe_serialization": True} if save_safetensors else {}
         if not isinstance(self.model, PreTrainedModel):
             print("Model is not an instance of PreTrainedModel")
             if isinstance(unwrap_model(self.model), PreTrainedModel):
                 print("Unwrapped model is an instance of PreTrainedModel, saving unwrapped model")
-                if state_dict is None:
-                    state_dict = self.model.state_dict()
-                unwrap_model(self.model).save_pretrained(output_dir, state_dict=state_dict)
+                unwrap_model(self.model).save_pretrained(output_dir, state_dict=state_dict, **save_kwargs)
             else:
                 print("Trainer.model is not a `PreTrainedModel`, only saving its state dict.")
                 if state_dict is None:
                     state_dict = self.model.state_dict()
-                torch.save(state_dict, os.path.join(output_dir, WEIGHTS_NAME))
+                if save_safetensors:
+                    safe_save_file(
+                        _untie_tensors(state_dict), os.path.join(output_dir, SAFE_WEIGHTS_NAME), metadata={"format": "pt"}
+                    )
+                else:
+                    torch.save(state_dict, os.path.join(output_dir, WEIGHTS_NAME))
         else:
             print("Model is an instance of PreTrainedModel, saving.")
-            self.model.save_pretrained(output_dir, state_dict=state_dict)
+            self.model.save_pretrained(output_dir, state_dict=state_dict, **save_kwargs)
         if self.tokenizer is not None:
             self.tokenizer.save_pretrained(output_dir)
 